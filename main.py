@@ -1,6 +1,18 @@
 import asyncio
+import contextlib
+import fcntl
+import functools
+import json
+import random
+import re
+import sqlite3
+import sys
+import time
+from collections import defaultdict
 from typing import Optional, Union, Tuple
 
+import ahocorasick
+
 from pyrogram import Client, filters, idle
 from pyrogram.types import Message
 from pyrogram.enums import ChatType, ChatMemberStatus, ParseMode
@@ -10,6 +22,28 @@ from pyrogram.errors import UserNotParticipant, FloodWait, RPCError, PeerIdInval
 from config import API_ID, API_HASH, BOT_TOKEN
 
 APP_NAME = "keyword_forward_bot"
+STATE_DB = f"{APP_NAME}_state.db"
+LOCK_FILE = f"/tmp/{APP_NAME}.lock"
+
+class AsyncTokenBucket:
+    """Refills `rate` tokens per second up to `burst`; acquire() waits for one."""
+    def __init__(self, rate: float, burst: int):
+        self.rate = rate
+        self.burst = burst
+        self.tokens = float(burst)
+        self.updated = time.monotonic()
+        self._lock = asyncio.Lock()
+
+    async def acquire(self):
+        async with self._lock:
+            while True:
+                now = time.monotonic()
+                self.tokens = min(self.burst, self.tokens + (now - self.updated) * self.rate)
+                self.updated = now
+                if self.tokens >= 1:
+                    self.tokens -= 1
+                    return
+                await asyncio.sleep((1 - self.tokens) / self.rate)
 
 class State:
     source_chat_id: Optional[int] = None
@@ -18,11 +52,87 @@ class State:
     end_id: Optional[int] = None
     next_id: Optional[int] = None
     keyword: str = "Completed"          # Default keyword
-    lock = asyncio.Lock()               # Prevent concurrent forwards
+    _kw_pat: Optional[re.Pattern] = re.compile("Completed", re.IGNORECASE)  # kept in sync by rebuild_matcher
+    _locks: dict = {}                   # (source, target) → asyncio.Lock
     custom_replies: dict = {}           # trigger → response
+    _chat_cache: dict = {}              # chat_id/username → (fetched_at, Chat)
+    _member_cache: dict = {}            # chat_id → (fetched_at, ChatMember)
+    _validated: dict = {}               # ("source"|"target", chat_id) → passed_at
+    prefetch: dict = {}                 # source message id → Message
+    _automaton = None                   # Aho-Corasick over reply triggers
+    _replies_regex: Optional[re.Pattern] = None  # one compiled pattern over all triggers, used by reply_filter
+    progress_buffer: list = []          # forwarded ids not yet reported
+    progress_msg_id: Optional[int] = None
+    progress_flushed_at: float = 0.0
+    persist_queue: asyncio.Queue = asyncio.Queue()  # (key, json value) awaiting write
+    trigger_queue: asyncio.Queue = asyncio.Queue()  # (client, trigger message) awaiting forward
+    _deferred: set = set()              # background retry_after / delayed flush tasks
+    _flood_streak: int = 0              # FloodWaits since the last successful copy
+    _flood_until: float = 0.0           # monotonic time before which no forward RPCs are made
+    _pending_acks: set = set()          # in-flight fire() tasks
+    _progress_lock = asyncio.Lock()     # keeps fired progress flushes in order
+    bucket_global = AsyncTokenBucket(rate=25, burst=30)                             # Telegram ~30 msg/s
+    bucket_per_chat = defaultdict(lambda: AsyncTokenBucket(rate=1.0, burst=3))    # ~1 msg/s per chat
+
+CHAT_CACHE_TTL = 60  # seconds
+VALIDATION_TTL = 300  # seconds a passed source/target check is trusted
+_VALID_CHAT_TYPES = frozenset({ChatType.CHANNEL, ChatType.SUPERGROUP, ChatType.GROUP})
+_GROUP_CHAT_TYPES = frozenset({ChatType.GROUP, ChatType.SUPERGROUP})
+PREFETCH_SIZE = 50   # source messages fetched per get_messages call
+PREFETCH_LOW = 10    # refill the window when fewer than this remain
+PROGRESS_BATCH = 10  # forwarded ids per progress update
+PROGRESS_INTERVAL = 5  # seconds before a partial batch is reported
+MAX_PENDING_ACKS = 100  # fire() waits for a slot beyond this
+RETRY_FLOOD_SLEEP = 60  # FloodWaits up to this are retried in place by with_telegram_retry
+MAX_FLOOD_SLEEP = 300  # longer FloodWaits are deferred instead of slept under the lock
+FORWARD_WORKERS = 3  # concurrent consumers of trigger_queue
+PERSIST_BATCH = 50   # state updates per sqlite commit
+PERSIST_INTERVAL = 0.5  # seconds to wait for more updates before committing
+PERSISTED_KEYS = ("source_chat_id", "target_chat_id", "start_id", "end_id", "next_id", "keyword", "custom_replies")
 
 app = Client(APP_NAME, api_id=API_ID, api_hash=API_HASH, bot_token=BOT_TOKEN)
 
+# ====================== PERSISTENCE ======================
+def load_state():
+    with contextlib.closing(sqlite3.connect(STATE_DB)) as db, db:
+        db.execute("CREATE TABLE IF NOT EXISTS state (key TEXT PRIMARY KEY, value TEXT)")
+        for key, value in db.execute("SELECT key, value FROM state"):
+            if key in PERSISTED_KEYS:
+                setattr(State, key, json.loads(value))
+
+def write_state(batch: dict):
+    with contextlib.closing(sqlite3.connect(STATE_DB)) as db, db:
+        db.executemany("INSERT OR REPLACE INTO state (key, value) VALUES (?, ?)", batch.items())
+
+def persist(*keys: str):
+    for key in keys:
+        State.persist_queue.put_nowait((key, json.dumps(getattr(State, key))))
+
+def snapshot_state() -> dict:
+    return {key: json.dumps(getattr(State, key)) for key in PERSISTED_KEYS}
+
+async def state_writer():
+    batch = {}  # kept across iterations so a failed write is retried with the next one
+    while True:
+        key, value = await State.persist_queue.get()
+        batch[key] = value
+        deadline = time.monotonic() + PERSIST_INTERVAL
+        while len(batch) < PERSIST_BATCH:
+            timeout = deadline - time.monotonic()
+            if timeout <= 0:
+                break
+            try:
+                key, value = await asyncio.wait_for(State.persist_queue.get(), timeout)
+            except asyncio.TimeoutError:
+                break
+            batch[key] = value
+        try:
+            await asyncio.to_thread(write_state, batch)
+        except Exception as e:
+            print(f"⚠️ State write failed: {e}")
+            continue
+        batch = {}
+
 # ====================== HELP TEXT ======================
 HELP = f"""
 🤖 **Keyword Forward Bot**
@@ -53,44 +163,181 @@ async def start_cmd(c: Client, m: Message):
     await c.send_message(m.chat.id, HELP, parse_mode=ParseMode.MARKDOWN)
 
 # ====================== UTILS ======================
-async def resolve_chat_id(client: Client, ident: Union[str, int]) -> int:
+async def throttled(chat_id: int, coro_factory):
+    await State.bucket_global.acquire()
+    await State.bucket_per_chat[chat_id].acquire()
+    return await coro_factory()
+
+def flood_delay(seconds: float, attempt: int = 0) -> float:
+    """Back off exponentially from Telegram's wait, plus jitter of up to half of MAX_FLOOD_SLEEP at most."""
+    delay = max(seconds, min(seconds * 2 ** attempt, MAX_FLOOD_SLEEP))
+    return delay + random.uniform(0, 0.5 * min(delay, MAX_FLOOD_SLEEP))
+
+def with_telegram_retry(max_retries: int = 3):
+    """Retry short FloodWaits in place; longer ones and other RPCErrors reach the caller."""
+    def deco(fn):
+        @functools.wraps(fn)
+        async def wrap(*args, **kwargs):
+            for attempt in range(max_retries):
+                try:
+                    return await fn(*args, **kwargs)
+                except FloodWait as e:
+                    if attempt == max_retries - 1 or e.value > RETRY_FLOOD_SLEEP:
+                        raise
+                    await asyncio.sleep(flood_delay(e.value, attempt))
+        return wrap
+    return deco
+
+@with_telegram_retry()
+async def fetch_messages(c: Client, chat_id: int, ids):
+    return await throttled(chat_id, lambda: c.get_messages(chat_id, ids))
+
+@with_telegram_retry()
+async def copy_to(c: Client, from_chat_id: int, chat_id: int, message_id: int):
+    return await throttled(chat_id, lambda: c.copy_message(
+        chat_id=chat_id,
+        from_chat_id=from_chat_id,
+        message_id=message_id
+    ))
+
+def _ack_done(task: asyncio.Task):
+    State._pending_acks.discard(task)
+    if not task.cancelled() and task.exception():
+        print(f"⚠️ Ack failed: {task.exception()}")
+
+async def fire(coro):
+    """Run `coro` in the background; only waits when MAX_PENDING_ACKS are in flight."""
+    if len(State._pending_acks) >= MAX_PENDING_ACKS:
+        await asyncio.wait(State._pending_acks, return_when=asyncio.FIRST_COMPLETED)
+    task = asyncio.create_task(coro)
+    State._pending_acks.add(task)
+    task.add_done_callback(_ack_done)
+
+async def notify(c: Client, chat_id: int, text: str):
+    await fire(throttled(chat_id, lambda: c.send_message(chat_id, text)))
+
+async def cached_get_chat(client: Client, ident: Union[str, int]):
+    hit = State._chat_cache.get(ident)
+    if hit and time.monotonic() - hit[0] < CHAT_CACHE_TTL:
+        return hit[1]
     chat = await client.get_chat(ident)
+    now = time.monotonic()
+    State._chat_cache[ident] = (now, chat)
+    State._chat_cache[chat.id] = (now, chat)
+    return chat
+
+async def cached_get_chat_member_me(client: Client, chat_id: int):
+    hit = State._member_cache.get(chat_id)
+    if hit and time.monotonic() - hit[0] < CHAT_CACHE_TTL:
+        return hit[1]
+    member = await client.get_chat_member(chat_id, "me")
+    State._member_cache[chat_id] = (time.monotonic(), member)
+    return member
+
+def invalidate_chat_cache(chat_id: Optional[Union[str, int]] = None):
+    if chat_id is None:
+        State._chat_cache.clear()
+        State._member_cache.clear()
+        State._validated.clear()
+        return
+    State._chat_cache.pop(chat_id, None)
+    State._member_cache.pop(chat_id, None)
+    State._validated.pop(("source", chat_id), None)
+    State._validated.pop(("target", chat_id), None)
+
+async def resolve_chat_id(client: Client, ident: Union[str, int]) -> int:
+    try:
+        chat = await cached_get_chat(client, ident)
+    except (PeerIdInvalid, ChannelInvalid):
+        invalidate_chat_cache(ident)
+        raise
     return chat.id
 
 async def can_read_source(client: Client, chat_id: int) -> Tuple[bool, str]:
+    if time.monotonic() - State._validated.get(("source", chat_id), float("-inf")) < VALIDATION_TTL:
+        return True, "OK (cached)"
     try:
-        chat = await client.get_chat(chat_id)
-        if chat.type not in (ChatType.CHANNEL, ChatType.SUPERGROUP, ChatType.GROUP):
+        chat = await cached_get_chat(client, chat_id)
+        if chat.type not in _VALID_CHAT_TYPES:
             return False, "Source must be a channel or group"
         try:
-            await client.get_chat_member(chat.id, "me")
+            await cached_get_chat_member_me(client, chat.id)
         except UserNotParticipant:
             return False, "Bot is not a member of the source"
+        State._validated[("source", chat_id)] = time.monotonic()
         return True, "OK"
     except (PeerIdInvalid, ChannelInvalid):
+        invalidate_chat_cache(chat_id)
         return False, "Invalid source chat"
     except Exception as e:
         return False, f"{e}"
 
 async def can_send_target(client: Client, chat_id: int) -> Tuple[bool, str]:
+    if time.monotonic() - State._validated.get(("target", chat_id), float("-inf")) < VALIDATION_TTL:
+        return True, "OK (cached)"
     try:
-        chat = await client.get_chat(chat_id)
-        if chat.type not in (ChatType.CHANNEL, ChatType.SUPERGROUP, ChatType.GROUP):
+        chat = await cached_get_chat(client, chat_id)
+        if chat.type not in _VALID_CHAT_TYPES:
             return False, "Target must be a channel or group"
         try:
-            member = await client.get_chat_member(chat.id, "me")
+            member = await cached_get_chat_member_me(client, chat.id)
         except UserNotParticipant:
             return False, "Bot is not a member of the target"
-        if member.status == ChatMemberStatus.ADMINISTRATOR:
-            return True, "OK"
-        if chat.type in (ChatType.GROUP, ChatType.SUPERGROUP):
+        if member.status == ChatMemberStatus.ADMINISTRATOR or chat.type in _GROUP_CHAT_TYPES:
+            State._validated[("target", chat_id)] = time.monotonic()
             return True, "OK"
         return False, "Bot must be admin in target channel to post"
     except (PeerIdInvalid, ChannelInvalid):
+        invalidate_chat_cache(chat_id)
         return False, "Invalid target chat"
     except Exception as e:
         return False, f"{e}"
 
+async def ensure_prefetch(client: Client):
+    if len(State.prefetch) >= PREFETCH_LOW:
+        return
+    hi = min(State.next_id + PREFETCH_SIZE, State.end_id + 1)
+    ids = [i for i in range(State.next_id, hi) if i not in State.prefetch]
+    if not ids:
+        return
+    msgs = await fetch_messages(client, State.source_chat_id, ids)
+    for msg in msgs:
+        # Empty ids may be posted later; leave them to the live fetch at trigger time
+        if not msg.empty:
+            State.prefetch[msg.id] = msg
+
+def rebuild_matcher():
+    a = ahocorasick.Automaton()
+    State._kw_pat = re.compile(re.escape(State.keyword), re.IGNORECASE) if State.keyword else None
+    words = list(State.custom_replies)
+    for w in words:
+        a.add_word(w, w)
+    if len(a):
+        a.make_automaton()
+        State._automaton = a
+        State._replies_regex = re.compile("|".join(map(re.escape, words)), re.IGNORECASE)
+    else:
+        State._automaton = None
+        State._replies_regex = None
+
+async def _reply_filter(_, __, m: Message) -> bool:
+    return bool(m.text and State._replies_regex and State._replies_regex.search(m.text))
+
+async def _keyword_filter(_, __, m: Message) -> bool:
+    return bool(m.text and State._kw_pat and State._kw_pat.search(m.text))
+
+# Both read State at dispatch time, so they follow keyword/reply changes without re-registering
+reply_filter = filters.create(_reply_filter)
+keyword_filter = filters.create(_keyword_filter)
+
+# Pyrogram's chat filter is a set; sync_target_filter() swaps the target in place
+target_filter = filters.chat([])
+
+def sync_target_filter():
+    target_filter.clear()
+    if State.target_chat_id is not None:
+        target_filter.add(State.target_chat_id)
+
 def ready_to_forward() -> Tuple[bool, str]:
     if State.source_chat_id is None:
         return False, "Source not set. Use /setsource"
@@ -112,65 +359,83 @@ def range_str() -> str:
 # ====================== COMMANDS ======================
 @app.on_message(filters.command("setsource"))
 async def cmd_set_source(c: Client, m: Message):
-    if len(m.command) < 2:
+    cmd = m.command
+    if len(cmd) < 2:
         return await c.send_message(m.chat.id, "Usage: /setsource <chat_id|@username>")
-    ident = m.command[1]
+    ident = cmd[1]
     try:
         chat_id = await resolve_chat_id(c, ident)
         ok, msg = await can_read_source(c, chat_id)
         if not ok:
             return await c.send_message(m.chat.id, f"❌ Source check failed: {msg}")
         State.source_chat_id = chat_id
+        State.prefetch = {}
+        persist("source_chat_id")
         await c.send_message(m.chat.id, f"✅ Source set to `{chat_id}`", parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
         await c.send_message(m.chat.id, f"❌ Failed to set source: {e}")
 
 @app.on_message(filters.command("settarget"))
 async def cmd_set_target(c: Client, m: Message):
-    if len(m.command) < 2:
+    cmd = m.command
+    if len(cmd) < 2:
         return await c.send_message(m.chat.id, "Usage: /settarget <chat_id|@username>")
-    ident = m.command[1]
+    ident = cmd[1]
     try:
         chat_id = await resolve_chat_id(c, ident)
         ok, msg = await can_send_target(c, chat_id)
         if not ok:
             return await c.send_message(m.chat.id, f"❌ Target check failed: {msg}")
         State.target_chat_id = chat_id
+        State.progress_buffer = []
+        State.progress_msg_id = None
+        sync_target_filter()
+        persist("target_chat_id")
         await c.send_message(m.chat.id, f"✅ Target set to `{chat_id}`", parse_mode=ParseMode.MARKDOWN)
     except Exception as e:
         await c.send_message(m.chat.id, f"❌ Failed to set target: {e}")
 
 @app.on_message(filters.command("setrange"))
 async def cmd_set_range(c: Client, m: Message):
-    if len(m.command) < 3:
+    cmd = m.command
+    if len(cmd) < 3:
         return await c.send_message(m.chat.id, "Usage: /setrange <first_id> <last_id>")
     try:
-        a = int(m.command[1])
-        b = int(m.command[2])
+        a = int(cmd[1])
+        b = int(cmd[2])
         lo = min(a, b)
         hi = max(a, b)
         State.start_id = lo
         State.end_id = hi
         State.next_id = lo
+        State.prefetch = {}
+        State.progress_msg_id = None
+        persist("start_id", "end_id", "next_id")
         await c.send_message(m.chat.id, f"✅ Range set to `{lo}..{hi}` (next: {State.next_id})", parse_mode=ParseMode.MARKDOWN)
     except ValueError:
         await c.send_message(m.chat.id, "❌ first_id and last_id must be integers")
 
 @app.on_message(filters.command("setkeyword"))
 async def cmd_set_keyword(c: Client, m: Message):
-    if len(m.command) < 2:
+    cmd = m.command
+    if len(cmd) < 2:
         return await c.send_message(m.chat.id, "Usage: /setkeyword <text>\nExample: /setkeyword Completed")
-    State.keyword = " ".join(m.command[1:]).strip()
+    State.keyword = " ".join(cmd[1:]).strip()
+    rebuild_matcher()
+    persist("keyword")
     await c.send_message(m.chat.id, f"✅ Keyword set to: `{State.keyword}`", parse_mode=ParseMode.MARKDOWN)
 
 # --- Custom Replies ---
 @app.on_message(filters.command("setreply"))
 async def cmd_set_reply(c: Client, m: Message):
-    if len(m.command) < 3:
+    cmd = m.command
+    if len(cmd) < 3:
         return await c.send_message(m.chat.id, "Usage: /setreply <trigger> <response>")
-    trigger = m.command[1].lower()
-    response = " ".join(m.command[2:])
+    trigger = cmd[1].lower()
+    response = " ".join(cmd[2:])
     State.custom_replies[trigger] = response
+    rebuild_matcher()
+    persist("custom_replies")
     await c.send_message(m.chat.id, f"✅ Reply set: `{trigger}` → `{response}`", parse_mode=ParseMode.MARKDOWN)
 
 @app.on_message(filters.command("replies"))
@@ -184,11 +449,14 @@ async def cmd_list_replies(c: Client, m: Message):
 
 @app.on_message(filters.command("delreply"))
 async def cmd_del_reply(c: Client, m: Message):
-    if len(m.command) < 2:
+    cmd = m.command
+    if len(cmd) < 2:
         return await c.send_message(m.chat.id, "Usage: /delreply <trigger>")
-    trigger = m.command[1].lower()
+    trigger = cmd[1].lower()
     if trigger in State.custom_replies:
         del State.custom_replies[trigger]
+        rebuild_matcher()
+        persist("custom_replies")
         await c.send_message(m.chat.id, f"✅ Deleted reply for `{trigger}`", parse_mode=ParseMode.MARKDOWN)
     else:
         await c.send_message(m.chat.id, f"❌ No reply found for `{trigger}`")
@@ -199,7 +467,7 @@ async def cmd_status(c: Client, m: Message):
         if chat_id is None:
             return "Not set"
         try:
-            ch = await c.get_chat(chat_id)
+            ch = await cached_get_chat(c, chat_id)
             label = ch.title or (f"@{ch.username}" if ch.username else str(chat_id))
             return f"{label} (`{chat_id}`)"
         except Exception:
@@ -224,73 +492,185 @@ async def cmd_reset(c: Client, m: Message):
     State.next_id = None
     State.keyword = "Completed"
     State.custom_replies = {}
+    State.prefetch = {}
+    State.progress_buffer = []
+    State.progress_msg_id = None
+    rebuild_matcher()
+    sync_target_filter()
+    invalidate_chat_cache()
+    persist(*PERSISTED_KEYS)
     await c.send_message(m.chat.id, "✅ Settings reset. Keyword reverted to `Completed`. All custom replies cleared.")
 
 # ====================== FORWARD LOGIC ======================
+async def flush_progress(c: Client, chat_id: int, force: bool = False):
+    if not State.progress_buffer:
+        return
+    due = time.monotonic() - State.progress_flushed_at >= PROGRESS_INTERVAL
+    if not (force or due or len(State.progress_buffer) >= PROGRESS_BATCH):
+        return
+    text = "➡️ Forwarded: " + ", ".join(map(str, State.progress_buffer))
+    State.progress_buffer = []
+    State.progress_flushed_at = time.monotonic()
+    await fire(_write_progress(c, chat_id, text))
+
+async def _delayed_flush(c: Client, chat_id: int):
+    await asyncio.sleep(PROGRESS_INTERVAL)
+    if chat_id == State.target_chat_id:
+        await flush_progress(c, chat_id, force=True)
+
+async def _write_progress(c: Client, chat_id: int, text: str):
+    async with State._progress_lock:
+        if State.progress_msg_id is not None:
+            try:
+                await throttled(chat_id, lambda: c.edit_message_text(chat_id, State.progress_msg_id, text))
+                return
+            except RPCError:
+                State.progress_msg_id = None
+        sent = await throttled(chat_id, lambda: c.send_message(chat_id, text))
+        State.progress_msg_id = sent.id
+
 async def forward_next_if_ready(c: Client, trigger_msg: Message):
     if State.target_chat_id is None or trigger_msg.chat.id != State.target_chat_id:
         return
     ok, why = ready_to_forward()
     if not ok:
-        await c.send_message(trigger_msg.chat.id, f"⚠️ Not ready to forward: {why}")
+        await notify(c, trigger_msg.chat.id, f"⚠️ Not ready to forward: {why}")
         return
-    async with State.lock:
-        if State.next_id is None or State.start_id is None or State.end_id is None:
+    src, tgt, chat_id = State.source_chat_id, State.target_chat_id, trigger_msg.chat.id
+    lock = State._locks.setdefault((src, tgt), asyncio.Lock())
+    async with lock:
+        flood_left = State._flood_until - time.monotonic()
+        if flood_left > 0:
+            # Telegram asked us to hold off; park the trigger without touching the API
+            defer_trigger(c, trigger_msg, flood_delay(flood_left))
+            return
+        # Work on locals and write next_id back once; skipped if a command moved it meanwhile
+        nid = first = State.next_id
+        end = State.end_id
+        if nid is None or State.start_id is None or end is None:
             return
-        if State.next_id > State.end_id:
-            await c.send_message(trigger_msg.chat.id, "✅ All messages in the range have already been forwarded.")
+        if nid > end:
+            await flush_progress(c, chat_id, force=True)
+            await notify(c, chat_id, "✅ All messages in the range have already been forwarded.")
             return
         try:
-            msg = await c.get_messages(State.source_chat_id, State.next_id)
+            await ensure_prefetch(c)
+            msg = State.prefetch.pop(nid, None)
+            if msg is None:
+                msg = await fetch_messages(c, src, nid)
             if not msg or msg.empty:
-                await c.send_message(trigger_msg.chat.id, f"⚠️ Skipping missing message ID {State.next_id}")
-                State.next_id += 1
+                await notify(c, chat_id, f"⚠️ Skipping missing message ID {nid}")
+                nid += 1
                 return
-            await c.copy_message(
-                chat_id=State.target_chat_id,
-                from_chat_id=State.source_chat_id,
-                message_id=State.next_id
-            )
-            await c.send_message(trigger_msg.chat.id, f"➡️ Forwarded message `{State.next_id}`", parse_mode=ParseMode.MARKDOWN)
-            State.next_id += 1
+            await copy_to(c, src, tgt, nid)
+            State._flood_streak = 0
+            if not State.progress_buffer:
+                track(asyncio.create_task(_delayed_flush(c, chat_id)))
+            State.progress_buffer.append(nid)
+            nid += 1
         except FloodWait as e:
-            await c.send_message(trigger_msg.chat.id, f"⏳ FloodWait: sleeping {e.value}s")
-            await asyncio.sleep(e.value)
+            delay = flood_delay(e.value, State._flood_streak)
+            State._flood_streak += 1
+            State._flood_until = time.monotonic() + e.value
+            if e.value > MAX_FLOOD_SLEEP:
+                await notify(c, chat_id, f"⏳ FloodWait: retrying ID {nid} in {delay:.0f}s")
+                defer_trigger(c, trigger_msg, delay)
+                return
+            await notify(c, chat_id, f"⏳ FloodWait: sleeping {delay:.0f}s")
+            await asyncio.sleep(delay)
+            State.trigger_queue.put_nowait((c, trigger_msg))
         except RPCError as e:
-            await c.send_message(trigger_msg.chat.id, f"❌ Forward error on ID {State.next_id}: {e}")
-            State.next_id += 1
+            await notify(c, chat_id, f"❌ Forward error on ID {nid}: {e}")
+            nid += 1
         except Exception as e:
-            await c.send_message(trigger_msg.chat.id, f"❌ Unexpected error on ID {State.next_id}: {e}")
-            State.next_id += 1
+            await notify(c, chat_id, f"❌ Unexpected error on ID {nid}: {e}")
+            nid += 1
+        finally:
+            if State.next_id == first:
+                State.next_id = nid
+                persist("next_id")
+            await flush_progress(c, chat_id, force=nid > end)
+
+async def retry_after(c: Client, trigger_msg: Message, delay: float):
+    await asyncio.sleep(delay)
+    State.trigger_queue.put_nowait((c, trigger_msg))
+
+def track(task: asyncio.Task):
+    State._deferred.add(task)
+    task.add_done_callback(State._deferred.discard)
+
+def defer_trigger(c: Client, trigger_msg: Message, delay: float):
+    track(asyncio.create_task(retry_after(c, trigger_msg, delay)))
+
+async def forward_worker():
+    while True:
+        c, trigger_msg = await State.trigger_queue.get()
+        try:
+            await forward_next_if_ready(c, trigger_msg)
+        except Exception as e:
+            print(f"⚠️ Forward worker error: {e}")
+        finally:
+            State.trigger_queue.task_done()
 
 # ====================== TEXT HANDLER ======================
-@app.on_message(filters.text)
+@app.on_message(filters.text & reply_filter)
 async def on_text(c: Client, m: Message):
-    if not m.text:
+    text, automaton, replies = m.text, State._automaton, State.custom_replies
+    if automaton is None:
         return
-    text_lower = m.text.lower()
+    hits = dict.fromkeys(w for _, w in automaton.iter(text.lower()))
 
-    # 1) Custom replies
-    for trigger, response in State.custom_replies.items():
-        if trigger in text_lower:
-            await c.send_message(m.chat.id, response, parse_mode=ParseMode.MARKDOWN)
+    chat_id = m.chat.id
+    for trigger in hits:
+        response = replies.get(trigger)
+        if response is not None:
+            await fire(throttled(chat_id, lambda r=response: c.send_message(chat_id, r, parse_mode=ParseMode.MARKDOWN)))
 
-    # 2) Forward keyword
-    if State.keyword and State.keyword.lower() in text_lower:
-        await forward_next_if_ready(c, m)
+# Separate group so a message can get both a custom reply and a forward. Group 1 still
+# runs after a command handler matched, so commands are excluded explicitly.
+@app.on_message(filters.text & ~filters.regex(r"^/") & target_filter & keyword_filter, group=1)
+async def on_keyword(c: Client, m: Message):
+    State.trigger_queue.put_nowait((c, m))
 
 # ====================== MAIN ======================
+def acquire_instance_lock():
+    """Return the held lock file, or None if another instance is already polling."""
+    f = open(LOCK_FILE, "w")
+    try:
+        fcntl.flock(f, fcntl.LOCK_EX | fcntl.LOCK_NB)
+    except OSError:
+        f.close()
+        return None
+    return f
+
 if __name__ == "__main__":
     print("🚀 Keyword Forward Bot starting…")
+    instance_lock = acquire_instance_lock()
+    if instance_lock is None:
+        print(f"❌ Another instance is already running (lock: {LOCK_FILE})")
+        sys.exit(1)
+    load_state()
+    rebuild_matcher()
+    sync_target_filter()
     try:
         app.start()
         print("✅ Bot connected.")
+        app.loop.create_task(state_writer())
+        for _ in range(FORWARD_WORKERS):
+            app.loop.create_task(forward_worker())
         idle()
     except KeyboardInterrupt:
         print("\n🛑 Stopped by user")
     finally:
+        if State._pending_acks:
+            app.loop.run_until_complete(asyncio.gather(*State._pending_acks, return_exceptions=True))
         try:
             app.stop()
             print("👋 Bot stopped.")
         except Exception:
             pass
+        # Let an in-flight state_writer commit finish, then overwrite it with the full
+        # current state; the writer's held batch may not have been written at all
+        app.loop.run_until_complete(app.loop.shutdown_default_executor())
+        write_state(snapshot_state())
+        instance_lock.close()